@@ -1,30 +1,41 @@
+import functools
 import logging
-import pickle
 import sys
 from pathlib import Path
 
-from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp, Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
 
 # --- CONFIGURAZIONE E COSTANTI ---
 SCOPES = ["https://www.googleapis.com/auth/youtube"]
 API_SERVICE_NAME = "youtube"
 API_VERSION = "v3"
 
+# Pool di connessioni condiviso da tutte le chiamate verso Google (API e
+# rinnovo del token), per riutilizzare le connessioni TLS già aperte.
+# `build_http` imposta il timeout di default del client (60 s): senza, una
+# chiamata bloccata terrebbe occupato il thread per sempre.
+_http = build_http()
 
-def get_authenticated_service(client_secrets_file: Path, token_pickle_file: Path):
+
+@functools.lru_cache(maxsize=4)
+def get_credentials(client_secrets_file: Path, token_file: Path) -> Credentials:
     """
-    Ottiene un'istanza del servizio API di YouTube autenticata.
+    Carica le credenziali OAuth dal file del token, rinnovandole o avviando
+    il flusso di autorizzazione se necessario. Il risultato è memorizzato per
+    processo: chiamate successive con gli stessi percorsi restituiscono le
+    stesse credenziali, che il refresher rinnova sul posto.
     """
     creds = None
-    if token_pickle_file.exists():
-        with open(token_pickle_file, "rb") as token:
-            creds = pickle.load(token)
+    if token_file.exists():
+        creds = Credentials.from_authorized_user_file(str(token_file), SCOPES)
 
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(Request(_http))
         else:
             if not client_secrets_file.exists():
                 logging.error(
@@ -36,10 +47,33 @@ def get_authenticated_service(client_secrets_file: Path, token_pickle_file: Path
                 client_secrets_file, SCOPES
             )
             creds = flow.run_local_server(port=0)
-        with open(token_pickle_file, "wb") as token:
-            pickle.dump(creds, token)
+        token_file.write_text(creds.to_json())
+
+    return creds
+
+
+def refresh_credentials(creds: Credentials, token_file: Path):
+    """Rinnova il token di accesso e lo salva su disco."""
+    creds.refresh(Request(_http))
+    token_file.write_text(creds.to_json())
+
 
-    return build(API_SERVICE_NAME, API_VERSION, credentials=creds)
+@functools.lru_cache(maxsize=4)
+def get_authenticated_service(creds: Credentials):
+    """
+    Ottiene un'istanza del servizio API di YouTube autenticata.
+
+    Le richieste di setup (list, insert, bind) dipendono l'una dall'altra e
+    non possono essere raggruppate in batch: condividono però il pool di
+    connessioni keep-alive, così l'handshake TLS viene pagato una sola volta.
+    """
+    return build(
+        API_SERVICE_NAME,
+        API_VERSION,
+        http=AuthorizedHttp(creds, http=_http),
+        static_discovery=True,
+        cache_discovery=False,
+    )
 
 
 def get_or_create_stream(youtube):
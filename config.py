@@ -1,3 +1,4 @@
+import functools
 import os
 import uuid
 from dataclasses import dataclass, field
@@ -5,9 +6,6 @@ from pathlib import Path
 
 from dotenv import load_dotenv
 
-# Carica le variabili d'ambiente dal file config.env
-load_dotenv(dotenv_path="config.env")
-
 
 # --- Funzioni helper per i valori di default ---
 def _get_node_id() -> str:
@@ -36,14 +34,18 @@ class Config:
     STREAM_HEIGHT: int = 720
     STREAM_FRAMERATE: int = 30
     STREAM_BITRATE: str = "6000k"
+    STREAM_BUFSIZE: str = "12000k"
     STREAM_PRESET: str = "ultrafast"
+    STREAM_CAPTURE_DISPLAY: str = field(
+        default_factory=lambda: os.getenv("SYNAPSE_CAPTURE_DISPLAY")
+    )
 
     # --- Configurazione di YouTube ---
     YOUTUBE_CLIENT_SECRETS_FILE: Path = field(
         default_factory=lambda: Path(__file__).parent / "client_secrets.json"
     )
-    YOUTUBE_TOKEN_PICKLE_FILE: Path = field(
-        default_factory=lambda: Path(__file__).parent / "token.pickle"
+    YOUTUBE_TOKEN_FILE: Path = field(
+        default_factory=lambda: Path(__file__).parent / "token.json"
     )
 
     # --- Configurazione del Renderer ---
@@ -60,6 +62,13 @@ class Config:
             )
 
 
+@functools.lru_cache(maxsize=1)
 def get_config() -> Config:
-    """Funzione helper per creare e validare un'istanza della configurazione."""
+    """
+    Funzione helper per creare e validare un'istanza della configurazione.
+    L'istanza viene creata una sola volta per processo; `get_config.cache_clear()`
+    forza una nuova lettura dell'ambiente.
+    """
+    # Carica le variabili d'ambiente dal file config.env
+    load_dotenv(dotenv_path="config.env")
     return Config()
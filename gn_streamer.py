@@ -1,19 +1,46 @@
 import asyncio
-import json
+import bisect
 import logging
+import os
 import random
 import sys
 import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import orjson
 
 from auth.youtube import (
     create_broadcast,
     get_authenticated_service,
+    get_credentials,
     get_or_create_stream,
+    refresh_credentials,
 )
 from config import Config, get_config
 from streamer.engine import StreamingEngine, WebSocketLogHandler, ws_manager
 from sync.git_agent import GitAgent
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop non è disponibile su Windows
+    uvloop = None
+
+
+def _run(coro):
+    """Esegue la coroutine su un loop uvloop, se disponibile."""
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
+
+def _atomic_write_bytes(path: Path, data: bytes):
+    """Scrive i dati in un file temporaneo e lo sostituisce atomicamente."""
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
 
 class SynapseNode:
     """Classe principale che orchestra un nodo della rete Synapse."""
@@ -26,28 +53,53 @@ class SynapseNode:
             node_id=config.NODE_ID,
         )
         self.streaming_engine = None
+        self.youtube_credentials = None
         self.youtube_service = None
         self.stream_id = None
         self.broadcast_id = None
         self.last_pulse_time = 0
+        self._last_state_bytes = None
+        self._sched_cache = None  # (ID dei nodi, ID ordinati, indice del nodo)
+
+    def _write_renderer_state(self, world_state: dict):
+        """Aggiorna il file di stato del renderer, solo se il contenuto cambia."""
+        buf = orjson.dumps(world_state)
+        if buf == self._last_state_bytes:
+            return
 
-    def _initial_sync(self):
+        _atomic_write_bytes(self.config.RENDERER_STATE_FILE, buf)
+        self._last_state_bytes = buf
+
+    async def _initial_sync(self):
         """Esegue la sincronizzazione iniziale con il repository Git."""
         logging.info("Esecuzione della sincronizzazione iniziale...")
-        self.git_agent.pull_changes()
-        world_state = self.git_agent.get_world_state()
-        with open(self.config.RENDERER_STATE_FILE, "w") as f:
-            json.dump(world_state, f)
+        await self.git_agent.pull_changes()
+        world_state = await self.git_agent.get_world_state()
+        self._write_renderer_state(world_state)
         logging.info("Stato iniziale sincronizzato.")
 
+    def _schedule_position(self, nodes: list) -> tuple:
+        """
+        Restituisce gli ID dei nodi ordinati e la posizione del nodo corrente
+        (None se assente), ricalcolandoli solo quando la membership cambia.
+        """
+        ids = frozenset(n["id"] for n in nodes)
+        if self._sched_cache is None or self._sched_cache[0] != ids:
+            sorted_ids = sorted(ids)
+            i = bisect.bisect_left(sorted_ids, self.config.NODE_ID)
+            found = i < len(sorted_ids) and sorted_ids[i] == self.config.NODE_ID
+            self._sched_cache = (ids, sorted_ids, i if found else None)
+        return self._sched_cache[1], self._sched_cache[2]
+
     def _authenticate_youtube(self):
         """Gestisce l'autenticazione e la creazione dello stream YouTube."""
         logging.info("Autenticazione con YouTube...")
         try:
-            self.youtube_service = get_authenticated_service(
+            self.youtube_credentials = get_credentials(
                 client_secrets_file=self.config.YOUTUBE_CLIENT_SECRETS_FILE,
-                token_pickle_file=self.config.YOUTUBE_TOKEN_PICKLE_FILE,
+                token_file=self.config.YOUTUBE_TOKEN_FILE,
             )
+            self.youtube_service = get_authenticated_service(self.youtube_credentials)
             rtmp_url, self.stream_id = get_or_create_stream(self.youtube_service)
             broadcast = create_broadcast(self.youtube_service, self.stream_id)
             self.broadcast_id = broadcast["id"]
@@ -62,35 +114,49 @@ class SynapseNode:
             logging.exception("Impossibile inizializzare lo stream di YouTube:")
             sys.exit(1)
 
+    async def _token_refresher(self):
+        """Rinnova il token di YouTube prima che scada, fuori dal percorso critico."""
+        REFRESH_MARGIN = 300  # Secondi prima della scadenza
+
+        creds = self.youtube_credentials
+        while creds.expiry is not None:
+            expiry = creds.expiry.replace(tzinfo=timezone.utc)
+            remaining = (expiry - datetime.now(timezone.utc)).total_seconds()
+            await asyncio.sleep(max(60, remaining - REFRESH_MARGIN))
+
+            try:
+                await asyncio.to_thread(
+                    refresh_credentials, creds, self.config.YOUTUBE_TOKEN_FILE
+                )
+                logging.info("Token di YouTube rinnovato.")
+            except Exception:
+                logging.exception("Impossibile rinnovare il token di YouTube:")
+
     async def _main_loop(self):
         """Loop principale che coordina i nodi per un push a turno (Round-Robin)."""
         PULSE_INTERVAL = 20  # Secondi
 
         while True:
             # 1. Sincronizza sempre lo stato locale con il remoto
-            self.git_agent.pull_changes()
-            self.git_agent.cleanup_local_events()
-            world_state = self.git_agent.get_world_state()
+            await self.git_agent.pull_changes()
+            await self.git_agent.cleanup_local_events()
+            world_state = await self.git_agent.get_world_state()
 
             # 2. Aggiorna il file di stato per il renderer locale
-            with open(self.config.RENDERER_STATE_FILE, "w") as f:
-                json.dump(world_state, f)
+            # (in un thread, per non bloccare lo streaming e i WebSocket)
+            await asyncio.to_thread(self._write_renderer_state, world_state)
 
             # 3. Logica dello scheduling Round-Robin
-            sorted_nodes = sorted(world_state.get("nodes", []), key=lambda n: n["id"])
-            if not sorted_nodes:
+            sorted_ids, my_index = self._schedule_position(
+                world_state.get("nodes", [])
+            )
+            if not sorted_ids:
                 logging.warning("Nessun nodo trovato per lo scheduling. Riprovo...")
                 await asyncio.sleep(self.config.TICK_INTERVAL_SECONDS)
                 continue
 
-            num_nodes = len(sorted_nodes)
-            try:
-                my_index = [
-                    i
-                    for i, n in enumerate(sorted_nodes)
-                    if n["id"] == self.config.NODE_ID
-                ][0]
-            except IndexError:
+            num_nodes = len(sorted_ids)
+            if my_index is None:
                 logging.warning(
                     "Nodo corrente non trovato nella lista dei nodi. Riprovo..."
                 )
@@ -106,23 +172,21 @@ class SynapseNode:
                     f"È il mio turno ({my_index}/{num_nodes}). Eseguo il push."
                 )
                 # 4. Esegui le operazioni di scrittura (solo il nodo di turno)
-                self.git_agent.push_heartbeat(self.broadcast_id)
+                await self.git_agent.push_heartbeat(self.broadcast_id)
 
                 # Invia un impulso se è passato abbastanza tempo
                 if (now - self.last_pulse_time) > PULSE_INTERVAL:
-                    other_nodes = [
-                        n
-                        for n in sorted_nodes
-                        if n["id"] != self.config.NODE_ID
-                    ]
-                    if other_nodes:
-                        target_node = random.choice(other_nodes)
-                        logging.info(
-                            f"Invio di un impulso al nodo: {target_node['id']}"
-                        )
-                        self.git_agent.push_event(
+                    if num_nodes > 1:
+                        # Sceglie un altro nodo a caso saltando la propria
+                        # posizione, senza costruire la lista degli altri nodi
+                        k = random.randrange(num_nodes - 1)
+                        if k >= my_index:
+                            k += 1
+                        target_id = sorted_ids[k]
+                        logging.info(f"Invio di un impulso al nodo: {target_id}")
+                        await self.git_agent.push_event(
                             event_type="pulse",
-                            data={"target_node_id": target_node["id"]},
+                            data={"target_node_id": target_id},
                             ttl_seconds=10,
                         )
                         self.last_pulse_time = now
@@ -135,10 +199,10 @@ class SynapseNode:
     async def run(self):
         """Avvia tutti i servizi e i loop del nodo."""
         logging.info(f"Nodo '{self.config.NODE_ID}' avviato.")
-        self._initial_sync()
+        await self._initial_sync()
         rtmp_url = self._authenticate_youtube()
 
-        self.git_agent.push_event(
+        await self.git_agent.push_event(
             event_type="node_joined",
             data={"broadcast_id": self.broadcast_id},
             ttl_seconds=30,
@@ -151,19 +215,27 @@ class SynapseNode:
             port=self.config.RENDERER_PORT,
             framerate=self.config.STREAM_FRAMERATE,
             bitrate=self.config.STREAM_BITRATE,
+            bufsize=self.config.STREAM_BUFSIZE,
             preset=self.config.STREAM_PRESET,
+            capture_display=self.config.STREAM_CAPTURE_DISPLAY,
         )
 
         streaming_task = asyncio.create_task(self.streaming_engine.start_streaming())
         sync_task = asyncio.create_task(self._main_loop())
+        token_task = asyncio.create_task(self._token_refresher())
 
-        await asyncio.gather(streaming_task, sync_task)
+        try:
+            await asyncio.gather(streaming_task, sync_task, token_task)
+        finally:
+            # Chiude browser e FFMPEG nel loop in cui sono stati aperti, anche
+            # quando i task vengono cancellati (es. Ctrl-C)
+            await self.shutdown()
 
     async def shutdown(self):
         """Esegue una chiusura pulita dei servizi."""
         if self.streaming_engine:
             logging.info("Avvio della procedura di spegnimento...")
-            await self.streaming_engine.stop_streaming()
+            await self.streaming_engine.close()
         logging.info("Nodo arrestato.")
 
 
@@ -182,14 +254,13 @@ def main():
     try:
         config = get_config()
         node = SynapseNode(config)
-        asyncio.run(node.run())
+        _run(node.run())
     except ValueError as e:
         logging.error(f"Errore di configurazione: {e}")
         sys.exit(1)
     except KeyboardInterrupt:
-        logging.info("\nArresto del nodo in corso...")
-        if node and node.streaming_engine:
-            asyncio.run(node.shutdown())
+        # Lo spegnimento è già avvenuto dentro `run`, prima che il loop si chiudesse
+        logging.info("\nNodo arrestato dall'utente.")
     finally:
         # La pulizia è gestita dal metodo shutdown e dal motore di streaming
         pass
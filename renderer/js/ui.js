@@ -3,6 +3,23 @@ document.addEventListener("DOMContentLoaded", function() {
     const socketUrl = `ws://${window.location.host}/ws/logs`;
     let socket;
 
+    function appendLogEntry(message) {
+        const entry = document.createElement("div");
+
+        // Simple parsing to add color based on log level
+        const lowerCaseMessage = message.toLowerCase();
+        let level = 'info';
+        if (lowerCaseMessage.includes('[warning]')) {
+            level = 'warning';
+        } else if (lowerCaseMessage.includes('[error]')) {
+            level = 'error';
+        }
+
+        entry.className = `log-entry ${level}`;
+        entry.textContent = message;
+        logContainer.appendChild(entry);
+    }
+
     function connect() {
         socket = new WebSocket(socketUrl);
 
@@ -15,21 +32,9 @@ document.addEventListener("DOMContentLoaded", function() {
         };
 
         socket.onmessage = function(event) {
-            const message = event.data;
-            const entry = document.createElement("div");
-            
-            // Simple parsing to add color based on log level
-            const lowerCaseMessage = message.toLowerCase();
-            let level = 'info';
-            if (lowerCaseMessage.includes('[warning]')) {
-                level = 'warning';
-            } else if (lowerCaseMessage.includes('[error]')) {
-                level = 'error';
-            }
-
-            entry.className = `log-entry ${level}`;
-            entry.textContent = message;
-            logContainer.appendChild(entry);
+            // Each message is a JSON array with the log lines of one batch
+            const messages = JSON.parse(event.data);
+            messages.forEach(appendLogEntry);
 
             // Auto-scroll to the bottom
             logContainer.scrollTop = logContainer.scrollHeight;
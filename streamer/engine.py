@@ -1,36 +1,165 @@
 import asyncio
+import base64
+import functools
 import logging
+import os
 import subprocess
+import tempfile
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Set
 
+import orjson
 import uvicorn
 from fastapi import FastAPI, WebSocket
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
+from playwright.async_api import Error as PlaywrightError
 from playwright.async_api import async_playwright
 from starlette.websockets import WebSocketDisconnect
 
+try:
+    import fcntl
+except ImportError:
+    # fcntl non è disponibile su Windows
+    fcntl = None
+
 # Costanti
 RENDERER_PATH = Path(__file__).parent.parent / "renderer"
+FRAME_QUEUE_SIZE = 2  # Frame in attesa di essere scritti verso FFMPEG
+PIPE_BUFFER_SIZE = 1 << 20  # Buffer della pipe verso FFMPEG (1 MB)
+# Parti fisse del comando FFMPEG: traccia audio muta, richiesta da YouTube
+FFMPEG_AUDIO_INPUT = (
+    "-f",
+    "lavfi",
+    "-i",
+    "anullsrc=channel_layout=stereo:sample_rate=44100",
+)
+FFMPEG_AUDIO_OUTPUT = ("-c:a", "aac", "-b:a", "128k")
+# Flag di Chromium per un'unica pagina da catturare: niente GPU, estensioni e
+# throttling dei timer in background, meno processi ausiliari e memoria.
+CHROMIUM_ARGS = (
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+    "--disable-features=TranslateUI,BackForwardCache",
+    "--mute-audio",
+    "--no-first-run",
+)
+LOG_QUEUE_SIZE = 1000  # Record di log trattenuti in attesa dell'invio
+LOG_BATCH_WINDOW = 0.05  # Secondi di attesa per raggruppare i log in un frame
+
+
+def _encoder_threads() -> int:
+    """Thread per l'encoder: metà dei core disponibili, il resto a Chromium."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity non è disponibile su tutte le piattaforme (es. macOS)
+        cpus = os.cpu_count() or 1
+    return max(1, cpus // 2)
+
+
+@functools.lru_cache(maxsize=1)
+def _nvenc_available() -> bool:
+    """
+    Verifica, una sola volta per processo, se FFMPEG riesce a codificare con
+    NVENC. Non basta che h264_nvenc compaia in `ffmpeg -encoders`: molte build
+    lo includono anche su macchine senza GPU NVIDIA, quindi si prova una
+    codifica reale di pochi frame.
+    """
+    try:
+        result = subprocess.run(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-f",
+                "lavfi",
+                "-i",
+                "color=size=256x256:duration=0.1",
+                "-c:v",
+                "h264_nvenc",
+                "-f",
+                "null",
+                "-",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=10,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
 
 
 class WebSocketManager:
     """Gestisce le connessioni WebSocket attive."""
 
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
+        self._queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._loop = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        """
+        Invia il messaggio a tutti i client in parallelo, così un client lento
+        non ritarda gli altri. I client su cui l'invio fallisce vengono rimossi.
+        """
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(message) for connection in connections),
+            return_exceptions=True,
+        )
+        for connection, result in zip(connections, results, strict=True):
+            if isinstance(result, Exception):
+                self.active_connections.discard(connection)
+
+    def enqueue(self, message: str):
+        """Accoda un messaggio per l'invio. Sicuro da qualsiasi thread."""
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if self._loop is None or running_loop is self._loop:
+            # Nessun consumatore ancora avviato, oppure siamo già nel suo loop
+            self._put(message)
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            pass  # Il loop è già stato chiuso
+
+    def _put(self, message: str):
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            pass  # I client non tengono il passo: il record viene scartato
+
+    async def drain_logs(self):
+        """
+        Invia i messaggi accodati: dopo il primo attende LOG_BATCH_WINDOW e
+        spedisce in un unico frame tutto ciò che è arrivato nel frattempo.
+        """
+        self._loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(LOG_BATCH_WINDOW)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self.broadcast(orjson.dumps(batch).decode())
 
 
 # Istanza globale del manager e dell'handler per i log
@@ -45,15 +174,10 @@ class WebSocketLogHandler(logging.Handler):
         self.manager = manager
 
     def emit(self, record):
-        log_entry = self.format(record)
-        try:
-            loop = asyncio.get_running_loop()
-            if loop.is_running():
-                loop.create_task(self.manager.broadcast(log_entry))
-        except RuntimeError:
-            # Il loop non è ancora in esecuzione, ignora l'invio al ws
-            # per i log iniziali.
-            pass
+        # I record vengono accodati e inviati da WebSocketManager.drain_logs:
+        # nessun task per record, e l'handler funziona anche dai thread di
+        # lavoro e prima che il loop sia avviato.
+        self.manager.enqueue(self.format(record))
 
 
 class StreamingEngine:
@@ -70,7 +194,9 @@ class StreamingEngine:
         port: int,
         framerate: int,
         bitrate: str,
+        bufsize: str,
         preset: str,
+        capture_display: Optional[str] = None,
     ):
         self.width = width
         self.height = height
@@ -78,14 +204,36 @@ class StreamingEngine:
         self.port = port
         self.framerate = framerate
         self.bitrate = bitrate
+        self.bufsize = bufsize
         self.preset = preset
+        # Se impostato (es. ":99"), il browser gira su quel display X e FFMPEG
+        # lo cattura direttamente con x11grab, senza passare i frame da Python.
+        self.capture_display = capture_display
 
         self.ffmpeg_process = None
+        self._ffmpeg_stdin = None
+        self._ffmpeg_argv = None
+        self._server_task = None
+        # Il contesto di Chromium resta aperto tra un riavvio dello streaming e
+        # l'altro; il profilo persistente conserva cache e shader compilati.
+        self._user_data_dir = Path(tempfile.gettempdir()) / f"synapse-chromium-{port}"
+        self._playwright = None
+        self.browser = None
+        self.page = None
+        self._cdp = None
+        self._frames = asyncio.Queue(maxsize=FRAME_QUEUE_SIZE)
         self.fastapi_app = self._create_fastapi_app()
 
     def _create_fastapi_app(self) -> FastAPI:
         """Crea e configura l'istanza del server web FastAPI."""
-        app = FastAPI()
+
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            drain_task = asyncio.create_task(ws_manager.drain_logs())
+            yield
+            drain_task.cancel()
+
+        app = FastAPI(lifespan=lifespan)
 
         @app.websocket("/ws/logs")
         async def websocket_endpoint(websocket: WebSocket):
@@ -114,99 +262,320 @@ class StreamingEngine:
         logging.info(f"Pannello di controllo disponibile su http://127.0.0.1:{self.port}/ui")
         await server.serve()
 
-    async def start_streaming(self):
-        """
-        Avvia l'intero processo di streaming.
-        """
-        asyncio.create_task(self._run_web_server())
-        await asyncio.sleep(1)  # Pausa per far avviare il server
-
-        ffmpeg_command = [
-            "ffmpeg",
+    def _ffmpeg_input_args(self) -> List[str]:
+        """Argomenti di input video di FFMPEG per la modalità di cattura scelta."""
+        if self.capture_display:
+            return [
+                "-f",
+                "x11grab",
+                "-framerate",
+                str(self.framerate),
+                "-video_size",
+                f"{self.width}x{self.height}",
+                "-draw_mouse",
+                "0",
+                "-i",
+                self.capture_display,
+            ]
+        return [
             "-f",
             "image2pipe",
-            "-framerate",
-            str(self.framerate),
+            "-use_wallclock_as_timestamps",
+            "1",
             "-c:v",
-            "png",
+            "mjpeg",
             "-i",
             "-",
-            "-f",
-            "lavfi",
-            "-i",
-            "anullsrc=channel_layout=stereo:sample_rate=44100",
-            "-c:v",
-            "libx264",
+        ]
+
+    def _build_ffmpeg_command(self) -> tuple:
+        """Compone il comando completo di FFMPEG per questo stream."""
+        return (
+            "ffmpeg",
+            *self._ffmpeg_input_args(),
+            *FFMPEG_AUDIO_INPUT,
+            *self._video_encoder_args(),
             "-pix_fmt",
             "yuv420p",
-            "-preset",
-            self.preset,
-            "-tune",
-            "zerolatency",
             "-b:v",
             self.bitrate,
-            "-c:a",
-            "aac",
-            "-b:a",
-            "128k",
+            "-maxrate",
+            self.bitrate,
+            "-bufsize",
+            self.bufsize,
+            "-fps_mode",
+            "cfr",
+            "-r",
+            str(self.framerate),
+            *FFMPEG_AUDIO_OUTPUT,
             "-f",
             "flv",
             self.youtube_stream_url,
+        )
+
+    def _video_encoder_args(self) -> List[str]:
+        """Argomenti dell'encoder video: NVENC se disponibile, altrimenti x264."""
+        if _nvenc_available():
+            logging.info("Encoder hardware NVENC rilevato.")
+            return ["-c:v", "h264_nvenc", "-preset", "p1", "-tune", "ll"]
+        return [
+            "-c:v",
+            "libx264",
+            "-preset",
+            self.preset,
+            "-tune",
+            "zerolatency",
+            "-threads",
+            str(_encoder_threads()),
         ]
 
-        self.ffmpeg_process = await asyncio.create_subprocess_exec(
-            *ffmpeg_command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+    @staticmethod
+    def _enlarge_pipe(fd: int):
+        """
+        Porta il buffer della pipe a PIPE_BUFFER_SIZE (solo Linux), così un
+        frame intero entra con una sola scrittura invece dei 64 KB predefiniti.
+        """
+        if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+            logging.info(
+                "Buffer della pipe verso FFMPEG non modificabile su questa "
+                "piattaforma: resta quello di default."
+            )
+            return
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+        except OSError as e:
+            logging.warning(f"Impossibile ingrandire la pipe verso FFMPEG: {e}")
+
+    async def _open_stdin_pipe(self):
+        """
+        Crea la pipe verso lo stdin di FFMPEG e la ingrandisce prima di avviare
+        il processo. La pipe è creata qui e non dal loop perché non tutti i
+        loop (es. uvloop) espongono il descrittore del trasporto dello stdin.
+        Restituisce l'estremo di lettura da passare a FFMPEG e lo StreamWriter
+        per l'estremo di scrittura.
+        """
+        read_fd, write_fd = os.pipe()
+        self._enlarge_pipe(write_fd)
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, os.fdopen(write_fd, "wb", buffering=0)
         )
+        return read_fd, asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def _launch_browser(self):
+        """
+        Avvia Chromium con un profilo persistente, headless oppure visibile sul
+        display da catturare.
+        """
+        options = {
+            "viewport": {"width": self.width, "height": self.height},
+            "args": list(CHROMIUM_ARGS),
+        }
+        if self.capture_display:
+            options["headless"] = False
+            options["args"] += [
+                "--kiosk",
+                f"--window-size={self.width},{self.height}",
+                "--window-position=0,0",
+            ]
+            options["env"] = {**os.environ, "DISPLAY": self.capture_display}
+        else:
+            options["headless"] = True
+
+        return await self._playwright.chromium.launch_persistent_context(
+            self._user_data_dir, **options
+        )
+
+    async def _ensure_page(self):
+        """Avvia il browser e carica il renderer, se non sono già aperti."""
+        if self.browser is None:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            self.browser = await self._launch_browser()
+            self.browser.on("close", self._on_browser_closed)
+            logging.info("Browser avviato.")
+
+        if self.page is None or self.page.is_closed():
+            # Il contesto persistente si apre già con una pagina vuota
+            pages = self.browser.pages
+            self.page = pages[0] if pages else await self.browser.new_page()
+            await self.page.goto(f"http://127.0.0.1:{self.port}")
+            logging.info("Pagina del renderer caricata.")
+
+    def _on_browser_closed(self, _context):
+        self.browser = None
+        self.page = None
+
+    async def _start_screencast(self):
+        """
+        Avvia lo screencast CDP: Chromium invia i frame già codificati in JPEG
+        a ogni commit del compositor, senza il costo di uno screenshot PNG.
+        """
+        self._cdp = await self.page.context.new_cdp_session(self.page)
+        self._cdp.on("Page.screencastFrame", self._on_frame)
+        await self._cdp.send(
+            "Page.startScreencast",
+            {
+                "format": "jpeg",
+                "quality": 80,
+                "maxWidth": self.width,
+                "maxHeight": self.height,
+                "everyNthFrame": 1,
+            },
+        )
+
+    async def start_streaming(self):
+        """
+        Avvia l'intero processo di streaming.
+        """
+        if self._server_task is None:
+            self._server_task = asyncio.create_task(self._run_web_server())
+            await asyncio.sleep(1)  # Pausa per far avviare il server
+
+        if self._ffmpeg_argv is None:
+            # Costruito una sola volta (la verifica dell'encoder lancia FFMPEG)
+            # e riutilizzato a ogni riavvio dello streaming.
+            self._ffmpeg_argv = await asyncio.to_thread(self._build_ffmpeg_command)
+
+        stdin = subprocess.DEVNULL
+        if not self.capture_display:
+            stdin, self._ffmpeg_stdin = await self._open_stdin_pipe()
+        try:
+            self.ffmpeg_process = await asyncio.create_subprocess_exec(
+                *self._ffmpeg_argv,
+                stdin=stdin,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        finally:
+            if stdin != subprocess.DEVNULL:
+                os.close(stdin)  # L'estremo di lettura ora è di FFMPEG
         logging.info("Processo FFMPEG avviato.")
 
-        async with async_playwright() as p:
-            self.browser = await p.chromium.launch(headless=True)
-            self.page = await self.browser.new_page(
-                viewport={"width": self.width, "height": self.height}
+        await self._ensure_page()
+
+        writer_task = None
+        if not self.capture_display:
+            await self._start_screencast()
+            writer_task = asyncio.create_task(self._feed_ffmpeg())
+
+        # Senza frame FFMPEG resterebbe in attesa sullo stdin per sempre: lo
+        # streaming termina anche se la pagina del renderer va in crash o si chiude.
+        page = self.page
+        page_lost = asyncio.get_running_loop().create_future()
+
+        def on_page_lost(_page):
+            if not page_lost.done():
+                page_lost.set_result(None)
+
+        page.on("crash", on_page_lost)
+        page.on("close", on_page_lost)
+        ffmpeg_exit = asyncio.ensure_future(self.ffmpeg_process.wait())
+
+        logging.info("--- INIZIO STREAMING ---")
+        try:
+            await asyncio.wait(
+                (ffmpeg_exit, page_lost), return_when=asyncio.FIRST_COMPLETED
             )
-            await self.page.goto(f"http://127.0.0.1:{self.port}")
-            logging.info("Browser headless avviato e pagina caricata.")
+            if page_lost.done():
+                logging.error(
+                    "La pagina del renderer è andata in crash o è stata chiusa. "
+                    "Fine dello streaming."
+                )
+            else:
+                logging.warning("FFMPEG è terminato. Fine dello streaming.")
+        except Exception:
+            logging.exception("Errore durante lo streaming:")
+        finally:
+            ffmpeg_exit.cancel()
+            page.remove_listener("crash", on_page_lost)
+            page.remove_listener("close", on_page_lost)
+            if writer_task is not None:
+                writer_task.cancel()
+            await self.stop_streaming()
+            if page_lost.done() and not page.is_closed():
+                # Una pagina in crash non si riprende: al prossimo avvio
+                # `_ensure_page` ne apre una nuova
+                try:
+                    await page.close()
+                except PlaywrightError:
+                    pass
+
+    async def _on_frame(self, params: dict):
+        """Accoda un frame ricevuto dallo screencast CDP."""
+        # L'ack parte subito, così Chromium prepara il frame successivo mentre
+        # questo viene decodificato e accodato.
+        ack = asyncio.ensure_future(
+            self._cdp.send(
+                "Page.screencastFrameAck", {"sessionId": params["sessionId"]}
+            )
+        )
+
+        frame = base64.b64decode(params["data"])
+        if self._frames.full():
+            # FFMPEG è in ritardo: scarta il frame più vecchio
+            self._frames.get_nowait()
+        self._frames.put_nowait(frame)
 
-            logging.info("--- INIZIO STREAMING ---")
+        await ack
+
+    async def _feed_ffmpeg(self):
+        """Scrive verso lo stdin di FFMPEG i frame accodati dallo screencast."""
+        stdin = self._ffmpeg_stdin
+        while not stdin.is_closing():
+            frame = await self._frames.get()
             try:
-                while True:
-                    screenshot_bytes = await self.page.screenshot()
-
-                    if self.ffmpeg_process.stdin.is_closing():
-                        logging.warning(
-                            "Lo stdin di FFMPEG è chiuso. Interruzione dello streaming."
-                        )
-                        break
-
-                    try:
-                        self.ffmpeg_process.stdin.write(screenshot_bytes)
-                        await self.ffmpeg_process.stdin.drain()
-                    except (BrokenPipeError, ConnectionResetError):
-                        logging.warning(
-                            "Pipe verso FFMPEG interrotta. Fine dello streaming."
-                        )
-                        break
-
-                    await asyncio.sleep(1 / self.framerate)
-            except Exception:
-                logging.exception("Errore durante il loop di streaming:")
-            finally:
-                await self.stop_streaming()
+                stdin.write(frame)
+                # drain() sospende solo se il buffer supera la soglia di default
+                # (64 KB): la contropressione resta sulla coda che scarta i
+                # frame vecchi, senza accumulare frame in ritardo nel buffer.
+                await stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                logging.warning("Pipe verso FFMPEG interrotta.")
+                break
 
     async def stop_streaming(self):
         """
-        Ferma il processo di streaming (FFMPEG e il browser).
+        Ferma il processo di streaming (screencast e FFMPEG). Il browser resta
+        aperto per un eventuale riavvio: viene chiuso da `close`.
         """
+        if self._cdp is not None:
+            try:
+                # Con la pagina in crash CDP potrebbe non rispondere più
+                await asyncio.wait_for(self._cdp.send("Page.stopScreencast"), 5)
+                await asyncio.wait_for(self._cdp.detach(), 5)
+            except (PlaywrightError, asyncio.TimeoutError):
+                pass  # Il browser potrebbe essere già stato chiuso
+            self._cdp = None
+
+        stdin, self._ffmpeg_stdin = self._ffmpeg_stdin, None
         if self.ffmpeg_process and self.ffmpeg_process.returncode is None:
             logging.info("Fermando FFMPEG...")
-            self.ffmpeg_process.stdin.close()
+            if stdin is not None:
+                stdin.close()  # FFMPEG chiude lo stream alla fine dell'input
+            else:
+                self.ffmpeg_process.terminate()
             await self.ffmpeg_process.wait()
+        elif stdin is not None:
+            stdin.close()
 
-        if hasattr(self, 'browser') and self.browser.is_connected():
-            logging.info("Chiudendo il browser headless...")
-            await self.browser.close()
+        # I frame rimasti in coda appartengono alla sessione appena chiusa
+        while not self._frames.empty():
+            self._frames.get_nowait()
 
         logging.info("Motore di streaming fermato.")
+
+    async def close(self):
+        """Ferma lo streaming e chiude il browser, alla chiusura del processo."""
+        await self.stop_streaming()
+
+        if self.browser is not None:
+            logging.info("Chiudendo il browser headless...")
+            try:
+                await self.browser.close()
+            except PlaywrightError:
+                pass  # Il browser potrebbe essere già stato chiuso
+
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
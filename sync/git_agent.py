@@ -1,11 +1,12 @@
-import json
+import asyncio
 import logging
 import os
 import time
 from functools import wraps
 from pathlib import Path
 
-from git import GitCommandError, Repo
+import orjson
+from git import Actor, GitCommandError, Repo
 
 
 def retry_on_git_error(max_retries=3, delay=5):
@@ -36,6 +37,19 @@ def retry_on_git_error(max_retries=3, delay=5):
     return decorator
 
 
+def _iter_json_files(directory: Path):
+    """Restituisce i DirEntry dei file .json in una cartella, se esiste."""
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json") and entry.is_file(
+                    follow_symlinks=False
+                ):
+                    yield entry
+    except FileNotFoundError:
+        return
+
+
 class GitAgent:
     """
     Gestisce l'interazione con il repository Git dello stato della rete.
@@ -53,7 +67,28 @@ class GitAgent:
                 "Controlla l'URL e le credenziali di accesso."
             )
 
-        self.node_file = self.local_path / "nodes" / f"{self.node_id}.json"
+        self._set_git_identity()
+
+        # Percorsi usati a ogni tick, calcolati una sola volta
+        self._nodes_dir = self.local_path / "nodes"
+        self._events_dir = self.local_path / "events"
+        self.node_file = self._nodes_dir / f"{self.node_id}.json"
+        self._node_file_str = str(self.node_file)
+        # Cache dei file JSON letti: percorso -> ((mtime_ns, dimensione), dati)
+        self._json_cache = {}
+
+    def _load_cached(self, path: str) -> dict:
+        """Legge un file JSON, riusando il risultato finché il file non cambia."""
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._json_cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+        self._json_cache[path] = (key, data)
+        return data
 
     @retry_on_git_error()
     def _init_repo(self) -> Repo:
@@ -65,18 +100,67 @@ class GitAgent:
             logging.info("Caricamento del repository locale esistente.")
             return Repo(self.local_path)
 
+    def _set_git_identity(self):
+        """
+        Passa a ogni comando git un'identità esplicita. `git commit` e
+        `git pull --rebase` falliscono se user.name/user.email non sono
+        configurati (es. nel container Docker); si usa quella configurata
+        o il default di GitPython (utente@host).
+        """
+        committer = Actor.committer(self.repo.config_reader())
+        self.repo.git.update_environment(
+            GIT_AUTHOR_NAME=committer.name,
+            GIT_AUTHOR_EMAIL=committer.email,
+            GIT_COMMITTER_NAME=committer.name,
+            GIT_COMMITTER_EMAIL=committer.email,
+        )
+
     @retry_on_git_error()
-    def pull_changes(self):
+    def _pull_changes_sync(self):
         """Scarica le ultime modifiche dal repository remoto."""
         logging.info("Esecuzione di 'git pull'...")
         origin = self.repo.remotes.origin
         origin.pull()
         logging.info("Pull completato.")
 
-    @retry_on_git_error()
-    def push_heartbeat(self, stream_id: str):
+    def _push_commits(self, max_retries=3, delay=5) -> bool:
+        """
+        Invia i commit locali. Un push rifiutato (un altro nodo ha inviato nel
+        frattempo) viene ritentato dopo aver riallineato i commit su origin,
+        senza ripetere la scrittura dei file né il commit. L'attesa tra i
+        tentativi raddoppia a ogni errore (es. rete non raggiungibile).
+        """
+        for attempt in range(max_retries):
+            try:
+                if attempt > 0:
+                    wait = delay * 2 ** (attempt - 1)
+                    logging.info(f"Nuovo tentativo di push in {wait} secondi...")
+                    time.sleep(wait)
+                    self.repo.git.pull("-q", "--rebase", "origin")
+                self.repo.git.push("-q", "origin", "HEAD")
+                return True
+            except GitCommandError as e:
+                logging.warning(
+                    f"Tentativo {attempt + 1}/{max_retries} di push fallito: {e}"
+                )
+                self._abort_rebase()
+
+        logging.error("Tutti i tentativi di push sono falliti.")
+        return False
+
+    def _abort_rebase(self):
+        """Annulla un rebase rimasto a metà, se presente."""
+        git_dir = Path(self.repo.git_dir)
+        if (git_dir / "rebase-merge").exists() or (git_dir / "rebase-apply").exists():
+            try:
+                self.repo.git.rebase("--abort")
+            except GitCommandError as e:
+                logging.warning(f"Impossibile annullare il rebase in corso: {e}")
+
+    @retry_on_git_error(max_retries=1)
+    def _push_heartbeat_sync(self, stream_id: str):
         """Aggiorna il file del nodo con un nuovo timestamp e fa il push."""
-        self.local_path.joinpath("nodes").mkdir(exist_ok=True)
+        self._nodes_dir.mkdir(exist_ok=True)
 
         current_time = int(time.time())
         creation_timestamp = current_time
@@ -84,12 +168,11 @@ class GitAgent:
         # Se il file esiste già, preserva il suo creation_timestamp
         if self.node_file.exists():
             try:
-                with open(self.node_file, "r") as f:
-                    existing_data = json.load(f)
-                    creation_timestamp = existing_data.get(
-                        "creation_timestamp", current_time
-                    )
-            except (json.JSONDecodeError, OSError):
+                existing_data = orjson.loads(self.node_file.read_bytes())
+                creation_timestamp = existing_data.get(
+                    "creation_timestamp", current_time
+                )
+            except (orjson.JSONDecodeError, OSError):
                 logging.warning(
                     f"Impossibile leggere il file del nodo esistente "
                     f"{self.node_file}. Ne verrà creato uno nuovo."
@@ -101,62 +184,62 @@ class GitAgent:
             "creation_timestamp": creation_timestamp,
         }
 
-        with open(self.node_file, "w") as f:
-            json.dump(node_data, f, indent=2)
+        self.node_file.write_bytes(
+            orjson.dumps(node_data, option=orjson.OPT_INDENT_2)
+        )
 
-        if self.repo.is_dirty(untracked_files=True):
-            logging.info("Rilevate modifiche, invio dell'heartbeat...")
-            self.repo.index.add([str(self.node_file)])
-            self.repo.index.commit(f"Heartbeat from node {self.node_id}")
-            self.repo.remotes.origin.push()
+        # Il timestamp cambia a ogni heartbeat, quindi c'è sempre qualcosa da
+        # committare: si invocano direttamente add/commit/push, senza il
+        # controllo is_dirty che da solo lancia più processi git.
+        logging.info("Invio dell'heartbeat...")
+        self.repo.git.add(self._node_file_str)
+        self.repo.git.commit("-q", "-m", f"Heartbeat from node {self.node_id}")
+        if self._push_commits():
             logging.info("Heartbeat inviato con successo.")
 
-    def get_world_state(self) -> dict:
+    def _get_world_state_sync(self) -> dict:
         """Legge nodi ed eventi per costruire lo stato del mondo."""
-        nodes_path = self.local_path / "nodes"
+        seen = set()
+
         nodes = []
-        if nodes_path.exists():
-            for file_path in nodes_path.glob("*.json"):
-                with open(file_path, "r") as f:
-                    try:
-                        data = json.load(f)
-                        nodes.append(
-                            {
-                                "id": file_path.stem,
-                                "stream_id": data.get("stream_id"),
-                                "timestamp": data.get("timestamp"),
-                                "creation_timestamp": data.get("creation_timestamp"),
-                            }
-                        )
-                    except json.JSONDecodeError:
-                        logging.warning(
-                            f"File JSON del nodo non valido: {file_path}"
-                        )
+        for entry in _iter_json_files(self._nodes_dir):
+            seen.add(entry.path)
+            try:
+                data = self._load_cached(entry.path)
+                nodes.append(
+                    {
+                        "id": entry.name[:-5],  # Nome del file senza ".json"
+                        "stream_id": data.get("stream_id"),
+                        "timestamp": data.get("timestamp"),
+                        "creation_timestamp": data.get("creation_timestamp"),
+                    }
+                )
+            except orjson.JSONDecodeError:
+                logging.warning(f"File JSON del nodo non valido: {entry.path}")
 
-        events_path = self.local_path / "events"
         events = []
-        if events_path.exists():
-            for file_path in events_path.glob("*.json"):
-                with open(file_path, "r") as f:
-                    try:
-                        data = json.load(f)
-                        events.append(data)
-                    except json.JSONDecodeError:
-                        logging.warning(
-                            f"File JSON dell'evento non valido: {file_path}"
-                        )
+        for entry in _iter_json_files(self._events_dir):
+            seen.add(entry.path)
+            try:
+                data = self._load_cached(entry.path)
+                events.append(data)
+            except orjson.JSONDecodeError:
+                logging.warning(f"File JSON dell'evento non valido: {entry.path}")
+
+        # Dimentica i file che non esistono più
+        for path in self._json_cache.keys() - seen:
+            del self._json_cache[path]
 
         connections = []
         return {"nodes": nodes, "connections": connections, "events": events}
 
-    @retry_on_git_error()
-    def push_event(self, event_type: str, data: dict, ttl_seconds: int = 60):
+    @retry_on_git_error(max_retries=1)
+    def _push_event_sync(self, event_type: str, data: dict, ttl_seconds: int = 60):
         """Crea, committa e invia un nuovo file di evento."""
-        events_path = self.local_path / "events"
-        events_path.mkdir(exist_ok=True)
+        self._events_dir.mkdir(exist_ok=True)
 
         event_id = f"{event_type}-{self.node_id}-{int(time.time())}"
-        event_file_path = events_path / f"{event_id}.json"
+        event_file_path = self._events_dir / f"{event_id}.json"
 
         event_data = {
             "id": event_id,
@@ -167,35 +250,45 @@ class GitAgent:
             "data": data,
         }
 
-        with open(event_file_path, "w") as f:
-            json.dump(event_data, f, indent=2)
+        event_file_path.write_bytes(
+            orjson.dumps(event_data, option=orjson.OPT_INDENT_2)
+        )
 
         logging.info(f"Invio dell'evento '{event_type}'...")
-        self.repo.index.add([str(event_file_path)])
-        self.repo.index.commit(f"event: {event_type} from {self.node_id}")
-        self.repo.remotes.origin.push()
-        logging.info("Evento inviato con successo.")
+        self.repo.git.add(str(event_file_path))
+        self.repo.git.commit("-q", "-m", f"event: {event_type} from {self.node_id}")
+        if self._push_commits():
+            logging.info("Evento inviato con successo.")
 
-    def cleanup_local_events(self):
-        """Rimuove gli eventi locali che sono scaduti (TTL)."""
-        events_path = self.local_path / "events"
-        if not events_path.exists():
-            return
+    def _event_deadline(self, path: str):
+        """Istante di scadenza di un evento, o None se il file non è valido."""
+        # La cache dei file JSON è verificata su mtime e dimensione: un evento
+        # viene riletto solo se il file cambia.
+        data = self._load_cached(path)
+        try:
+            return float(data.get("timestamp", 0)) + float(data.get("ttl", 60))
+        except (AttributeError, TypeError, ValueError):
+            return None
 
+    def _cleanup_local_events_sync(self):
+        """Rimuove gli eventi locali che sono scaduti (TTL)."""
+        now = time.time()
         files_to_remove = []
-        for file_path in events_path.glob("*.json"):
-            with open(file_path, "r") as f:
-                try:
-                    data = json.load(f)
-                    created_at = data.get("timestamp", 0)
-                    ttl = data.get("ttl", 60)
-                    if time.time() > created_at + ttl:
-                        files_to_remove.append(str(file_path))
-                except (json.JSONDecodeError, AttributeError):
-                    files_to_remove.append(str(file_path))
+        for entry in _iter_json_files(self._events_dir):
+            try:
+                deadline = self._event_deadline(entry.path)
+            except FileNotFoundError:
+                continue  # Rimosso nel frattempo
+            except orjson.JSONDecodeError:
+                deadline = None
+            if deadline is None or now > deadline:
+                files_to_remove.append(entry.path)
 
         if files_to_remove:
             logging.info(f"Pulizia di {len(files_to_remove)} eventi scaduti...")
+            # La rimozione resta solo nell'indice: un commit locale non inviato
+            # farebbe divergere il branch da origin e bloccherebbe il pull.
+            # Viene inclusa nel prossimo commit del nodo di turno.
             self.repo.index.remove(files_to_remove, working_tree=False)
             for f in files_to_remove:
                 try:
@@ -204,3 +297,29 @@ class GitAgent:
                     logging.warning(
                         f"Errore nella rimozione del file evento locale {f}: {e}"
                     )
+
+    # --- API asincrona ---
+    # Le operazioni Git e di I/O su disco possono durare secondi: vengono
+    # eseguite in un thread per non bloccare il loop di asyncio.
+
+    async def pull_changes(self):
+        """Scarica le ultime modifiche dal repository remoto."""
+        return await asyncio.to_thread(self._pull_changes_sync)
+
+    async def push_heartbeat(self, stream_id: str):
+        """Aggiorna il file del nodo con un nuovo timestamp e fa il push."""
+        return await asyncio.to_thread(self._push_heartbeat_sync, stream_id)
+
+    async def get_world_state(self) -> dict:
+        """Legge nodi ed eventi per costruire lo stato del mondo."""
+        return await asyncio.to_thread(self._get_world_state_sync)
+
+    async def push_event(self, event_type: str, data: dict, ttl_seconds: int = 60):
+        """Crea, committa e invia un nuovo file di evento."""
+        return await asyncio.to_thread(
+            self._push_event_sync, event_type, data, ttl_seconds
+        )
+
+    async def cleanup_local_events(self):
+        """Rimuove gli eventi locali che sono scaduti (TTL)."""
+        return await asyncio.to_thread(self._cleanup_local_events_sync)
@@ -1,10 +1,25 @@
-import os
-
 import pytest
 
 from config import get_config
 
 
+@pytest.fixture(autouse=True, scope="module")
+def _env():
+    """Imposta una sola volta l'ambiente di base condiviso dai test del modulo."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("SYNAPSE_GIT_REPO_URL", "https://github.com/default/repo.git")
+        mp.delenv("SYNAPSE_NODE_ID", raising=False)
+        yield mp
+
+
+@pytest.fixture(autouse=True)
+def _fresh_config():
+    """Garantisce che ogni test legga la configurazione dall'ambiente corrente."""
+    get_config.cache_clear()
+    yield
+    get_config.cache_clear()
+
+
 def test_config_loads_from_env(monkeypatch):
     """Verifica che la configurazione carichi correttamente le variabili d'ambiente."""
     # Imposta variabili d'ambiente fittizie per il test
@@ -29,17 +44,11 @@ def test_config_missing_required_env_raises_error(monkeypatch):
 
 def test_config_default_node_id():
     """Verifica che venga generato un NODE_ID di default se non specificato."""
-    # Rimuovi la variabile NODE_ID se esiste, per testare il default
-    if "SYNAPSE_NODE_ID" in os.environ:
-        del os.environ["SYNAPSE_NODE_ID"]
-
-    # Imposta la variabile richiesta per evitare l'errore
-    os.environ["SYNAPSE_GIT_REPO_URL"] = "https://github.com/default/repo.git"
-
     config = get_config()
 
     assert config.NODE_ID.startswith("node_")
     assert len(config.NODE_ID) == 5 + 8 # "node_" + 8 caratteri esadecimali
 
-    # Pulisci la variabile d'ambiente dopo il test
-    del os.environ["SYNAPSE_GIT_REPO_URL"]
+def test_config_is_cached():
+    """Verifica che la configurazione venga creata una sola volta per processo."""
+    assert get_config() is get_config()
@@ -0,0 +1,153 @@
+import json
+import time
+
+import pytest
+from git import Repo
+
+from sync.git_agent import GitAgent
+
+
+@pytest.fixture(autouse=True)
+def _git_env(tmp_path, monkeypatch):
+    """Isola git dalla configurazione dell'utente: nessuna identità impostata."""
+    empty_config = tmp_path / "gitconfig"
+    empty_config.touch()
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", str(empty_config))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    for var in (
+        "GIT_AUTHOR_NAME",
+        "GIT_AUTHOR_EMAIL",
+        "GIT_COMMITTER_NAME",
+        "GIT_COMMITTER_EMAIL",
+        "EMAIL",
+    ):
+        monkeypatch.delenv(var, raising=False)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Registra le attese tra i tentativi invece di dormire davvero."""
+    calls = []
+    monkeypatch.setattr(time, "sleep", calls.append)
+    return calls
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """Repository remoto bare con un primo commit, come il repo dello stato."""
+    bare = tmp_path / "remote.git"
+    Repo.init(bare, bare=True)
+    seed = Repo.clone_from(bare, tmp_path / "seed")
+    (tmp_path / "seed" / "README.md").write_text("synapse-state\n")
+    seed.index.add(["README.md"])
+    seed.index.commit("init")
+    seed.git.push("origin", "HEAD")
+    return bare
+
+
+def _agent(tmp_path, remote, node_id: str) -> GitAgent:
+    return GitAgent(str(remote), str(tmp_path / node_id), node_id)
+
+
+def _remote_subjects(remote) -> list:
+    return Repo(remote).git.log("--format=%s").splitlines()
+
+
+def test_heartbeat_is_pushed_without_git_identity(tmp_path, remote):
+    """Verifica che commit e push funzionino senza user.name/user.email."""
+    agent = _agent(tmp_path, remote, "node_a")
+
+    agent._push_heartbeat_sync("stream-a")
+
+    assert _remote_subjects(remote)[0] == "Heartbeat from node node_a"
+
+
+def test_rejected_push_is_rebased_without_replaying_commit(tmp_path, remote, sleeps):
+    """Verifica che un push rifiutato ritenti solo il push, dopo un rebase."""
+    a = _agent(tmp_path, remote, "node_a")
+    b = _agent(tmp_path, remote, "node_b")
+
+    b._push_heartbeat_sync("stream-b")
+    a._push_event_sync("pulse", {"target_node_id": "node_b"}, ttl_seconds=10)
+
+    subjects = _remote_subjects(remote)
+    assert subjects[:2] == ["event: pulse from node_a", "Heartbeat from node node_b"]
+    events = Repo(remote).head.commit.tree["events"]
+    assert len(events.blobs) == 1
+    assert sleeps == [5]
+
+
+def test_push_gives_up_with_backoff_when_remote_unreachable(
+    tmp_path, remote, sleeps
+):
+    """Verifica che gli errori di rete vengano ritentati con attesa crescente."""
+    agent = _agent(tmp_path, remote, "node_a")
+    agent.repo.git.remote("set-url", "origin", str(tmp_path / "missing.git"))
+
+    assert agent._push_commits() is False
+    assert sleeps == [5, 10]
+
+
+def test_conflicting_rebase_is_aborted(tmp_path, remote, sleeps):
+    """Verifica che un rebase in conflitto venga annullato e non resti a metà."""
+    a = _agent(tmp_path, remote, "node_a")
+    b = _agent(tmp_path, remote, "node_b")
+
+    # Un altro nodo invia una versione diversa dello stesso file
+    b._nodes_dir.mkdir()
+    (b._nodes_dir / "node_a.json").write_text('{"stream_id": "other"}')
+    b.repo.git.add(str(b._nodes_dir / "node_a.json"))
+    b.repo.git.commit("-q", "-m", "conflict")
+    b.repo.git.push("-q", "origin", "HEAD")
+
+    a._push_heartbeat_sync("stream-a")
+
+    git_dir = tmp_path / "node_a" / ".git"
+    assert not (git_dir / "rebase-merge").exists()
+    assert not (git_dir / "rebase-apply").exists()
+    assert a.repo.head.commit.message.startswith("Heartbeat from node node_a")
+    assert _remote_subjects(remote)[0] == "conflict"
+    assert sleeps == [5, 10]
+
+
+def _write_event(agent: GitAgent, name: str, content) -> None:
+    path = agent._events_dir / f"{name}.json"
+    path.write_text(content if isinstance(content, str) else json.dumps(content))
+
+
+def test_cleanup_removes_expired_events_across_sweeps(tmp_path, remote, monkeypatch):
+    """Verifica la pulizia degli eventi per TTL su due passaggi successivi."""
+    agent = _agent(tmp_path, remote, "node_a")
+    agent._events_dir.mkdir()
+    now = time.time()
+    created = int(now) - 15
+
+    _write_event(agent, "pulse", {"timestamp": created, "ttl": 10})
+    _write_event(agent, "join", {"timestamp": created, "ttl": 30})
+    _write_event(agent, "default", {"timestamp": created})
+    _write_event(agent, "rewritten", {"timestamp": created, "ttl": 60})
+    _write_event(agent, "gone", {"timestamp": created, "ttl": 60})
+    _write_event(agent, "bad_ttl", {"timestamp": created, "ttl": "soon"})
+    _write_event(agent, "broken", "{")
+    agent.repo.git.add(str(agent._events_dir))
+    agent.repo.git.commit("-q", "-m", "events")
+
+    def sweep(at: float) -> set:
+        with monkeypatch.context() as m:
+            m.setattr(time, "time", lambda: at)
+            agent._cleanup_local_events_sync()
+        return {p.stem for p in agent._events_dir.glob("*.json")}
+
+    assert sweep(now) == {"join", "default", "rewritten", "gone"}
+    staged = agent.repo.git.diff("--cached", "--name-only").split()
+    assert sorted(staged) == [
+        "events/bad_ttl.json",
+        "events/broken.json",
+        "events/pulse.json",
+    ]
+
+    # Tra un passaggio e l'altro un file sparisce e uno viene riscritto
+    (agent._events_dir / "gone.json").unlink()
+    _write_event(agent, "rewritten", {"timestamp": created, "ttl": 5})
+
+    assert sweep(now + 20) == {"default"}